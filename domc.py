@@ -1,33 +1,90 @@
 import digitalocean
 import sys
 import time
+import random
 import logging
 import datetime
 from dotenv import load_dotenv
 import os
 import json
+import orjson
+import asyncio
+import functools
+import argparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Load API from .env
 load_dotenv()
+API_TOKEN = os.environ.get('DO_API_TOKEN')
 
 # Setup logging
 logging.basicConfig(filename='latest.log', level=logging.DEBUG, format='%(asctime)s %(message)s')
 
-def get_api_token():
-    return os.environ.get('DO_API_TOKEN')
-
+def notify(msg, level=logging.INFO):
+    # Format once, then send the same message to the log and the console
+    logging.log(level, msg)
+    print(msg)
+
+class SafeRetry(Retry):
+    # POSTs here (create, shutdown, snapshot, detach) aren't idempotent, so they're
+    # left out of allowed_methods and never resent after a 5xx or read error,
+    # where the backend may already have acted. A 429 means the request was
+    # rejected outright, so POST is retried on that alone; connect errors are
+    # retried for any method by urllib3 itself.
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method and method.upper() == 'POST':
+            return status_code == 429
+        return super().is_retry(method, status_code, has_retry_after)
+
+def build_session():
+    # Retry rate-limited (429) and transient 5xx responses with backoff
+    retry = SafeRetry(total=8,
+                      backoff_factor=0.5,
+                      status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=frozenset(['GET', 'DELETE', 'PUT']))
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def install_shared_session(session):
+    # BaseAPI.__init__ assigns a fresh requests.Session to self._session on every
+    # SDK object (including those returned by get_droplet/get_volume). Make
+    # _session a class-level property instead: reads return the shared session,
+    # and the per-object session handed to the setter is closed right away.
+    def set_session(self, value):
+        if value is not session:
+            value.close()
+
+    digitalocean.baseapi.BaseAPI._session = property(lambda self: session, set_session)
+
+# One keep-alive session shared by every SDK object. The detach path calls the SDK
+# from asyncio.to_thread workers, so it's used concurrently. That is safe because
+# the urllib3 connection pool behind the adapter is thread-safe, and the only
+# state send() mutates per response is session.cookies, which the CookieJar
+# guards with its own lock. Headers and adapters are never changed after setup.
+SESSION = build_session()
+install_shared_session(SESSION)
+
+@functools.lru_cache(maxsize=4)
+def _cached_ssh_keys(token):
+    return digitalocean.Manager(token=token).get_all_sshkeys()
+
+@functools.lru_cache(maxsize=1)
 def read_config():
     config_path = 'config.json'
 
-    if not os.path.exists(config_path):
-        logging.error(f"Configuration file not found: {config_path}")
-        raise FileNotFoundError(f"Configuration file not found: {config_path}")
-
     try:
         with open(config_path, 'r') as file:
             config = json.load(file)
+    except FileNotFoundError:
+        logging.error("Configuration file not found: %s", config_path)
+        raise
     except json.JSONDecodeError as e:
-        logging.error(f"Error parsing configuration file: {e}")
+        logging.error("Error parsing configuration file: %s", e)
         raise
 
     if 'VOLUME' not in config:
@@ -47,15 +104,24 @@ def extract_snapshot_details(snapshot):
         'size_gigabytes': snapshot.size_gigabytes
     }
 
+# Parsed snapshot_info.json, populated on first read and by update_snapshot_info
+_snapshot_cache = None
+
 def read_snapshot_info():
+    global _snapshot_cache
+    if _snapshot_cache is not None:
+        return _snapshot_cache
+
     snapshot_info_path = 'snapshot_info.json'
-    if not os.path.exists(snapshot_info_path):
+    try:
+        with open(snapshot_info_path, 'rb') as file:
+            _snapshot_cache = orjson.loads(file.read())
+    except FileNotFoundError:
         return {}  # Return empty dict if file doesn't exist
-
-    with open(snapshot_info_path, 'r') as file:
-        return json.load(file)
+    return _snapshot_cache
 
 def update_snapshot_info(snapshot):
+    global _snapshot_cache
     snapshot_info_path = 'snapshot_info.json'
     snapshot_data = {
         "id": snapshot['id'],
@@ -69,48 +135,91 @@ def update_snapshot_info(snapshot):
         # Add any other fields you want to store
     }
 
-    with open(snapshot_info_path, 'w') as file:
-        json.dump(snapshot_data, file, indent=4)
-    logging.info(f"Snapshot information updated for {snapshot['id']}")
-
-def wait_for_action_completion(droplet, action_type):
-    action_complete = False
-    while not action_complete:
-        actions = droplet.get_actions()
-        for action in actions:
-            action.load()
-            if action.type == action_type and action.status == 'completed':
-                action_complete = True
-                break
-        time.sleep(3)
-    logging.info(f"Action {action_type} completed for droplet {droplet.id}.")
-    print(f"Action {action_type} completed for droplet {droplet.id}.")
-
-def wait_for_volume_detachment(manager, droplet_id, volume_id):
-    while True:
-        droplet = manager.get_droplet(droplet_id)
-        droplet.load()
-        if volume_id not in droplet.volume_ids:
-            logging.info(f"Volume {volume_id} successfully detached from droplet {droplet_id}.")
-            print(f"Volume {volume_id} successfully detached from droplet {droplet_id}.")
-            break
-        time.sleep(3)
+    # Write to a temp file and swap it in so a crash never leaves a truncated file
+    tmp_path = snapshot_info_path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(orjson.dumps(snapshot_data, option=orjson.OPT_INDENT_2))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, snapshot_info_path)
+    _snapshot_cache = snapshot_data
+    logging.info("Snapshot information updated for %s", snapshot['id'])
+
+def backoff_delay(attempt, initial, cap):
+    # Clamp the exponent: unbounded waits would otherwise overflow float at 2**1024
+    return min(cap, initial * 2 ** min(attempt, 16)) + random.uniform(0, initial)
+
+def poll(predicate, initial=1.0, cap=30.0, max_elapsed=1800):
+    # Exponential backoff with jitter: ~1s, 2s, 4s, ... capped at `cap` seconds.
+    # max_elapsed=None polls until the predicate holds, however long that takes.
+    start = time.monotonic()
+    attempt = 0
+    while not predicate():
+        if max_elapsed is not None and time.monotonic() - start > max_elapsed:
+            raise TimeoutError(f"Condition not met within {max_elapsed} seconds")
+        time.sleep(backoff_delay(attempt, initial, cap))
+        attempt += 1
+
+async def poll_async(predicate, initial=1.0, cap=30.0, max_elapsed=1800):
+    # Same schedule as poll(), for awaitable predicates
+    start = time.monotonic()
+    attempt = 0
+    while not await predicate():
+        if max_elapsed is not None and time.monotonic() - start > max_elapsed:
+            raise TimeoutError(f"Condition not met within {max_elapsed} seconds")
+        await asyncio.sleep(backoff_delay(attempt, initial, cap))
+        attempt += 1
+
+def wait_for_action_completion(droplet, action_id, max_elapsed=1800):
+    # Poll the one action we initiated rather than listing the droplet's history
+    action = digitalocean.Action(token=droplet.token, id=action_id)
+
+    def action_completed():
+        action.load()
+        if action.status == 'errored':
+            raise RuntimeError(f"Action {action_id} ({action.type}) errored.")
+        return action.status == 'completed'
+
+    poll(action_completed, max_elapsed=max_elapsed)
+    notify(f"Action {action.type} completed for droplet {droplet.id}.")
+    return action
+
+async def wait_for_volume_detachment(semaphore, droplet, volume_ids):
+    # One droplet load per tick covers every volume; each load takes a
+    # semaphore slot only for the duration of that call
+    pending = set(volume_ids)
+    first_check = True
+
+    async def volumes_detached():
+        nonlocal first_check
+        # The caller's droplet is already loaded; only refresh on later polls
+        if not first_check:
+            await do_call(semaphore, droplet.load)
+        first_check = False
+        detached = [volume_id for volume_id in volume_ids
+                    if volume_id in pending and volume_id not in droplet.volume_ids]
+        for volume_id in detached:
+            notify(f"Volume {volume_id} successfully detached from droplet {droplet.id}.")
+        pending.difference_update(detached)
+        return not pending
+
+    await poll_async(volumes_detached)
 
 def cleanup_droplet(manager, droplet_id):
     try:
         droplet = manager.get_droplet(droplet_id)
         droplet.destroy()
-        logging.info(f"Cleaned up droplet with ID: {droplet_id}")
+        logging.info("Cleaned up droplet with ID: %s", droplet_id)
     except Exception as e:
-        logging.error(f"Failed to clean up droplet: {e}")
+        logging.error("Failed to clean up droplet: %s", e)
 
 def cleanup_volume(manager, volume_id):
     try:
         volume = manager.get_volume(volume_id)
         volume.destroy()
-        logging.info(f"Cleaned up volume with ID: {volume_id}")
+        logging.info("Cleaned up volume with ID: %s", volume_id)
     except Exception as e:
-        logging.error(f"Failed to clean up volume: {e}")
+        logging.error("Failed to clean up volume: %s", e)
 
 def create_volume(manager, region, size_gigabytes, name):
     volume = digitalocean.Volume(token=manager.token,
@@ -118,8 +227,7 @@ def create_volume(manager, region, size_gigabytes, name):
                                  size_gigabytes=size_gigabytes,
                                  name=name)
     volume.create()
-    logging.info(f"Volume created with ID: {volume.id}")
-    print(f"Volume created with ID: {volume.id}")
+    notify(f"Volume created with ID: {volume.id}")
     return volume
 
 def create_droplet(manager, volume):
@@ -127,7 +235,7 @@ def create_droplet(manager, volume):
     creation_successful = False
 
     try:
-        keys = manager.get_all_sshkeys()
+        keys = _cached_ssh_keys(manager.token)
         droplet = digitalocean.Droplet(token=manager.token,
                                     name='ExampleDroplet',
                                     region='blr1',
@@ -137,16 +245,15 @@ def create_droplet(manager, volume):
                                     volumes=[volume.id],  # Attach volume during creation
                                     backups=False)
         droplet.create()
-        logging.info(f"Droplet created with ID: {droplet.id}, with volume {volume.id} attached")
-        print(f"Droplet created with ID: {droplet.id}, with volume {volume.id} attached")
+        notify(f"Droplet created with ID: {droplet.id}, with volume {volume.id} attached")
 
-        wait_for_action_completion(droplet, 'create')
+        wait_for_action_completion(droplet, droplet.action_ids[0])
 
         creation_successful = True
         return droplet
 
     except Exception as e:
-        logging.error(f"Error during droplet creation: {e}")
+        logging.error("Error during droplet creation: %s", e)
         raise
     finally:
         if droplet and not creation_successful:
@@ -156,24 +263,21 @@ def restore_droplet_from_snapshot(manager, volume_id):
     # Read snapshot ID from snapshot_info.json
     snapshot_info = read_snapshot_info()
     if not snapshot_info:
-        logging.error("No snapshot information found.")
-        print("No snapshot information found.")
+        notify("No snapshot information found.", level=logging.ERROR)
         return
 
     snapshot_id = snapshot_info.get("id")
     if not snapshot_id:
-        logging.error("No snapshot ID found in snapshot information.")
-        print("No snapshot ID found in snapshot information.")
+        notify("No snapshot ID found in snapshot information.", level=logging.ERROR)
         return
 
     try:
         snapshot = manager.get_image(snapshot_id)
-        logging.info(f"Snapshot found: {snapshot_id}")
+        logging.info("Snapshot found: %s", snapshot_id)
     except digitalocean.NotFoundError:
-        logging.error(f"Snapshot ID not found: {snapshot_id}")
-        print(f"Snapshot ID not found: {snapshot_id}")
+        notify(f"Snapshot ID not found: {snapshot_id}", level=logging.ERROR)
         return
-    keys = manager.get_all_sshkeys()
+    keys = _cached_ssh_keys(manager.token)
 
     # Create a droplet from the snapshot with the volume attached
     droplet = digitalocean.Droplet(token=manager.token,
@@ -185,96 +289,114 @@ def restore_droplet_from_snapshot(manager, volume_id):
                                    volumes=[volume_id],  # Attach volume during creation
                                    backups=False)
     droplet.create()
-    logging.info(f"Restoration of droplet {droplet.id} initiated from snapshot {snapshot_id}.")
-    print(f"Restoration of droplet {droplet.id} initiated from snapshot {snapshot_id}.")
+    notify(f"Restoration of droplet {droplet.id} initiated from snapshot {snapshot_id}.")
 
     # Wait for droplet creation to complete
-    wait_for_action_completion(droplet, 'create')
+    wait_for_action_completion(droplet, droplet.action_ids[0])
+
+# Cap on concurrent in-flight DigitalOcean API calls from the async paths
+API_CONCURRENCY = 5
+
+async def do_call(semaphore, fn, *args, **kwargs):
+    async with semaphore:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+
+async def detach_volumes(manager, droplet):
+    # Built here, inside the running loop: each asyncio.run() has its own loop and
+    # a semaphore can't be shared across loops
+    semaphore = asyncio.Semaphore(API_CONCURRENCY)
+    volume_ids = list(droplet.volume_ids)
+
+    async def detach(volume_id):
+        volume = await do_call(semaphore, manager.get_volume, volume_id)
+        await do_call(semaphore, volume.detach, droplet.id, droplet.region['slug'])
+        notify(f"Initiating detachment of volume {volume.id} from droplet {droplet.id}")
+
+    # Fire all detach requests up front, then wait for them together
+    await asyncio.gather(*[detach(volume_id) for volume_id in volume_ids])
+    await wait_for_volume_detachment(semaphore, droplet, volume_ids)
 
 def shutdown_and_snapshot(manager, droplet_id, skip_snapshot=False):
     droplet = manager.get_droplet(droplet_id)
 
     # Initiate droplet shutdown
-    droplet.shutdown()
-    logging.info("Droplet shutdown initiated.")
-    print("Droplet shutdown initiated.")
+    response = droplet.shutdown()
+    notify("Droplet shutdown initiated.")
 
     # Wait for droplet to be powered off
-    wait_for_action_completion(droplet, 'shutdown')
+    wait_for_action_completion(droplet, response['action']['id'])
 
-    # Detach volumes before snapshotting/destroying
-    droplet.load()
+    # Detach volumes before snapshotting/destroying. Shutdown doesn't change
+    # attachments, so the volume_ids from get_droplet() are still current
+    if droplet.volume_ids is None:
+        droplet.load()
     if droplet.volume_ids:
-        for volume_id in droplet.volume_ids:
-            volume = manager.get_volume(volume_id)
-            volume.detach(droplet.id, droplet.region['slug'])
-            logging.info(f"Initiating detachment of volume {volume.id} from droplet {droplet.id}")
-            print(f"Initiating detachment of volume {volume.id} from droplet {droplet.id}")
-
-        # Wait for each volume to be detached
-        for volume_id in droplet.volume_ids:
-            wait_for_volume_detachment(manager, droplet.id, volume_id)
+        asyncio.run(detach_volumes(manager, droplet))
 
     if skip_snapshot:
-        logging.info("Skipping snapshot creation as per request.")
-        print("Skipping snapshot creation as per request.")
+        notify("Skipping snapshot creation as per request.")
     else:
         # Proceed with snapshot logic
         timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
         snapshot_name = f"Snapshot-{droplet.id}-{timestamp}"
 
-        droplet.take_snapshot(snapshot_name, return_dict=True)
-        logging.info(f"Snapshot initiation for droplet {droplet.id} started.")
-        print(f"Snapshot initiation for droplet {droplet.id} started.")
+        known_snapshot_ids = set(droplet.snapshot_ids or [])
+        response = droplet.take_snapshot(snapshot_name, return_dict=True)
+        notify(f"Snapshot initiation for droplet {droplet.id} started.")
 
-        wait_for_action_completion(droplet, 'snapshot')
+        # Snapshots of large disks can outlast any fixed limit; giving up here
+        # would leave the droplet off with its volumes detached
+        wait_for_action_completion(droplet, response['action']['id'], max_elapsed=None)
 
-        # Fetch the snapshot by name
-        snapshots = manager.get_all_snapshots()
-        my_snapshot = next((snap for snap in snapshots if snap.name == snapshot_name), None)
+        # The snapshot action's resource is the droplet itself, so resolve the
+        # new snapshot from the droplet's own snapshot IDs instead of listing
+        # every snapshot on the account
+        droplet.load()
+        new_snapshot_ids = [snapshot_id for snapshot_id in droplet.snapshot_ids
+                            if snapshot_id not in known_snapshot_ids]
 
-        if my_snapshot:
+        if new_snapshot_ids:
+            my_snapshot = manager.get_snapshot(new_snapshot_ids[-1])
             snapshot_details = extract_snapshot_details(my_snapshot)
-            logging.info(f"Snapshot completed with ID: {my_snapshot.id}")
-            print(f"Snapshot completed with ID: {my_snapshot.id}")
+            notify(f"Snapshot completed with ID: {my_snapshot.id}")
             update_snapshot_info(snapshot_details)
         else:
-            logging.error(f"No snapshot with name {snapshot_name} found.")
-            print(f"No snapshot with name {snapshot_name} found.")
+            notify(f"No snapshot with name {snapshot_name} found.", level=logging.ERROR)
 
     # Destroy droplet
     droplet.destroy()
-    logging.info("Droplet destroyed.")
-    print("Droplet destroyed.")
+    notify("Droplet destroyed.")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Manage DigitalOcean droplets and volumes.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('create', help="Create a volume and a droplet with it attached")
+    destroy_parser = subparsers.add_parser('destroy', help="Shut down, snapshot and destroy a droplet")
+    destroy_parser.add_argument('droplet_id', nargs='?',
+                                help="ID of the droplet to destroy (prompted for if omitted)")
+    destroy_parser.add_argument('--skip-snapshot', '-s', action='store_true',
+                                help="Destroy the droplet without taking a snapshot")
+    subparsers.add_parser('restore', help="Restore a droplet from the last snapshot")
+    return parser.parse_args(argv)
 
 def main():
+    # Validate the command line before touching config or the API
+    args = parse_args()
     config = read_config()
-    api = get_api_token()
-    manager = digitalocean.Manager(token=api)
-
-    if len(sys.argv) < 2:
-        print("Usage: python script.py [create|destroy|restore]")
-        sys.exit(1)
+    manager = digitalocean.Manager(token=API_TOKEN)
 
-    command = sys.argv[1].lower()
-
-    if command == 'create':
+    if args.command == 'create':
         volume = create_volume(manager, 'blr1', 10, 'examplevolume2')
         droplet = create_droplet(manager, volume)
-    elif command == 'destroy':
-        droplet_id = input("Enter the Droplet ID to destroy: ")
-        skip_snapshot = '-s' in sys.argv
-        shutdown_and_snapshot(manager, droplet_id, skip_snapshot)
-    elif command == 'restore':
+    elif args.command == 'destroy':
+        droplet_id = args.droplet_id or input("Enter the Droplet ID to destroy: ")
+        shutdown_and_snapshot(manager, droplet_id, args.skip_snapshot)
+    elif args.command == 'restore':
         restore_droplet_from_snapshot(manager, config['VOLUME'])
-    else:
-        print("Invalid command.")
-        sys.exit(1)
 
 if __name__ == "__main__":
     try:
         main()
     except Exception as e:
-        logging.error(f"An error occurred: {e}")
-        print(f"An error occurred: {e}")
+        notify(f"An error occurred: {e}", level=logging.ERROR)
         sys.exit(1)
\ No newline at end of file